@@ -65,7 +65,8 @@ document.addEventListener('DOMContentLoaded', () => {
     function pollForStatus(taskId) {
         const intervalId = setInterval(async () => {
             try {
-                const response = await fetch(`/tasks/${taskId}`);
+                // Poll the lightweight status endpoint; the result is only fetched once the task has finished.
+                const response = await fetch(`/tasks/${taskId}/status`);
                 
                 
                 if (response.status === 404) {
@@ -93,6 +94,12 @@ document.addEventListener('DOMContentLoaded', () => {
                     clearInterval(intervalId);
                     resetButton(); 
 
+                    const detailsResponse = await fetch(`/tasks/${taskId}`);
+                    if (!detailsResponse.ok) {
+                        throw new Error(`HTTP error! Status: ${detailsResponse.status}`);
+                    }
+                    result.result = (await detailsResponse.json()).result;
+
                     if (status === 'COMPLETED') {
                         
                         statusMessage += `<br><b>Result:</b> <pre>${JSON.stringify(result.result, null, 2)}</pre>`;
@@ -0,0 +1,59 @@
+import asyncio
+import os
+
+import pytest
+
+# The CI job (and docker-compose) configure Postgres through POSTGRES_* variables;
+# map them onto what the worker and the API read before either module is imported.
+os.environ.setdefault("DB_HOST", "localhost")
+os.environ.setdefault("DB_USER", os.getenv("POSTGRES_USER", "user"))
+os.environ.setdefault("DB_PASSWORD", os.getenv("POSTGRES_PASSWORD", "password"))
+os.environ.setdefault("DB_NAME", os.getenv("POSTGRES_DB", "db"))
+os.environ.setdefault("REDIS_HOST", "localhost")
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault(
+  "POSTGRES_DSN",
+  "postgresql://{DB_USER}:{DB_PASSWORD}@/{DB_NAME}?host={DB_HOST}".format(**os.environ),
+)
+os.environ.setdefault("REDIS_DSN", "redis://{REDIS_HOST}:{REDIS_PORT}".format(**os.environ))
+
+# Mirrors the columns the API and the worker use; the repo ships no migrations.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+  id uuid PRIMARY KEY,
+  task_name text NOT NULL,
+  status text NOT NULL,
+  submitted_at timestamptz NOT NULL DEFAULT NOW(),
+  started_at timestamptz,
+  completed_at timestamptz,
+  result jsonb
+)
+"""
+
+
+async def _pg_fetch(query, *args):
+  import asyncpg
+
+  conn = await asyncpg.connect(os.environ["POSTGRES_DSN"])
+  try:
+    return await conn.fetch(query, *args)
+  finally:
+    await conn.close()
+
+
+def sql(query, *args):
+  """Runs one statement on a throwaway connection and returns its rows."""
+  return asyncio.run(_pg_fetch(query, *args))
+
+
+@pytest.fixture
+def services():
+  """Gives a test an empty tasks table and an empty Redis database."""
+  import redis
+
+  sql(SCHEMA)
+  sql("TRUNCATE tasks")
+  client = redis.Redis(host=os.environ["REDIS_HOST"], port=int(os.environ["REDIS_PORT"]))
+  client.flushdb()
+  yield client
+  client.close()
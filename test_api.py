@@ -0,0 +1,124 @@
+import uuid
+
+import asyncpg
+import msgpack
+import pytest
+from fastapi.testclient import TestClient
+
+from api import main
+from conftest import sql
+
+
+@pytest.fixture
+def client(services):
+  with TestClient(main.app) as client:
+    yield client
+
+
+def insert_task(task_id, status="PENDING"):
+  sql("INSERT INTO tasks (id, task_name, status) VALUES ($1, 'fetch_ip', $2)", task_id, status)
+
+
+@pytest.mark.parametrize("task_id", [
+  "not-a-uuid",
+  "123e4567-e89b-12d3-a456-42661417400",
+  "123e4567-e89b-12d3-a456-4266141740000",
+  "123e4567e89b12d3a456426614174000",
+  "123e4567-e89b-12d3-a456-42661417400g",
+])
+@pytest.mark.parametrize("suffix", ["", "/status"])
+def test_invalid_task_id_is_rejected(client, task_id, suffix):
+  response = client.get(f"/tasks/{task_id}{suffix}")
+  assert response.status_code == 400
+  assert response.json()["detail"] == "Invalid Task ID format."
+
+
+def test_unknown_task_id_is_not_found(client):
+  response = client.get(f"/tasks/{uuid.uuid4()}")
+  assert response.status_code == 404
+
+
+@pytest.mark.parametrize("suffix", ["", "/status"])
+def test_upper_case_task_id_uses_the_canonical_cache_key(client, services, suffix):
+  task_id = uuid.uuid4()
+  insert_task(task_id, status="COMPLETED")
+
+  response = client.get(f"/tasks/{str(task_id).upper()}{suffix}")
+
+  assert response.status_code == 200
+  assert response.json()["id"] == str(task_id)
+  assert services.exists(f"task:{task_id}{suffix.replace('/', ':')}")
+  assert services.keys(f"task:{str(task_id).upper()}*") == []
+
+
+def queued_jobs(services):
+  return [
+    msgpack.unpackb(fields[b"payload"], raw=False)
+    for _, fields in services.xrange("task_stream")
+  ]
+
+
+def test_bulk_submit_creates_rows_and_queues_jobs_in_order(client, services):
+  tasks = [
+    {"task_name": "fetch_ip", "params": {"hostname": "example.com"}},
+    {"task_name": "scan_url", "params": {"url": "https://example.com"}},
+    {"task_name": "fetch_ip", "params": {"hostname": "example.org"}},
+  ]
+
+  response = client.post("/tasks/bulk", json=tasks)
+
+  assert response.status_code == 202
+  task_ids = response.json()["task_ids"]
+  assert len(set(task_ids)) == len(tasks)
+
+  rows = {str(row["id"]): row for row in sql("SELECT id, task_name, status FROM tasks")}
+  assert [rows[task_id]["task_name"] for task_id in task_ids] == [t["task_name"] for t in tasks]
+  assert {row["status"] for row in rows.values()} == {"PENDING"}
+
+  assert queued_jobs(services) == [
+    {"task_id": task_id, **task} for task_id, task in zip(task_ids, tasks)
+  ]
+
+
+def test_bulk_submit_of_nothing_touches_nothing(client, services):
+  response = client.post("/tasks/bulk", json=[])
+
+  assert response.status_code == 202
+  assert response.json() == {"task_ids": []}
+  assert sql("SELECT id FROM tasks") == []
+  assert services.exists("task_stream") == 0
+
+
+def test_bulk_submit_queues_nothing_when_the_copy_fails(client, services, monkeypatch):
+  existing = uuid.uuid4()
+  insert_task(existing)
+  monkeypatch.setattr(main.uuid, "uuid4", lambda: existing)
+
+  with pytest.raises(asyncpg.UniqueViolationError):
+    client.post("/tasks/bulk", json=[{"task_name": "fetch_ip", "params": {}}])
+
+  assert services.exists("task_stream") == 0
+
+
+def test_submit_creates_the_row_and_queues_the_job(client, services):
+  # Several submits reuse the same pooled connections, not just a fresh one each.
+  task_ids = []
+  for n in range(3):
+    response = client.post("/tasks", json={"task_name": "fetch_ip", "params": {"n": n}})
+    assert response.status_code == 202
+    task_ids.append(response.json()["task_id"])
+
+  rows = sql("SELECT id, status FROM tasks")
+  assert sorted(str(row["id"]) for row in rows) == sorted(task_ids)
+  assert sorted(job["task_id"] for job in queued_jobs(services)) == sorted(task_ids)
+
+
+def test_submit_queues_nothing_when_the_insert_fails(client, services, monkeypatch):
+  existing = uuid.uuid4()
+  insert_task(existing)
+  monkeypatch.setattr(main.uuid, "uuid4", lambda: existing)
+
+  with pytest.raises(asyncpg.UniqueViolationError):
+    client.post("/tasks", json={"task_name": "fetch_ip", "params": {}})
+
+  assert services.exists("task_stream") == 0
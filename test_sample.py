@@ -1,18 +1,34 @@
-import time
+import asyncio
 
-def fetch_ip(hostname: str):
-  print("Fetching details of website")
-  time.sleep(1)
-  print(f"The IP address of {hostname} is 192.1.1.1")
-  return {"hostname": f"{hostname}" , "ip" : "192.1.1.1}
+import pytest
 
-def test_ip():
+from worker import worker
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+  delays = []
+
+  async def record(seconds):
+    delays.append(seconds)
+
+  monkeypatch.setattr(worker, "_sleep", record)
+  return delays
+
+def test_ip(no_sleep):
   host = "www.google.com"
 
-  results = fetch_ip(host)
+  results = asyncio.run(worker.fetch_ip(host))
   assert isinstance(results , dict)
-  assert "ip" in results
+  assert "ip_address" in results
   assert "hostname" in results
 
 
   assert results["hostname"] == host
+  assert no_sleep == [2]
+
+def test_scan_url(no_sleep):
+  results = asyncio.run(worker.scan_url("https://example.com"))
+
+  assert results["status_code"] == 200
+  assert results["vulnerabilities_found"] == 0
+  assert no_sleep == [5]
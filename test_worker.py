@@ -0,0 +1,180 @@
+import asyncio
+import os
+import uuid
+
+import msgpack
+import orjson
+import pytest
+import redis.asyncio as aioredis
+
+from conftest import sql
+from worker import worker
+
+
+async def instant_task(value: int):
+  return {"value": value}
+
+
+def cpu_square(value: int):
+  return {"square": value * value, "pid": os.getpid()}
+
+
+def cpu_crash():
+  os._exit(1)
+
+
+def job(task_id, task_name="instant_task", **params):
+  return {"payload": msgpack.packb(
+    {"task_id": str(task_id), "task_name": task_name, "params": params}, use_bin_type=True
+  )}
+
+
+def insert_task(task_id):
+  sql("INSERT INTO tasks (id, task_name, status) VALUES ($1, 'instant_task', 'PENDING')", task_id)
+
+
+@pytest.fixture
+def stream(services, monkeypatch):
+  """A fresh task stream with the worker group created, plus a fast task in the registry."""
+  monkeypatch.setitem(worker.TASK_REGISTRY, "instant_task", instant_task)
+
+  async def create():
+    async with aioredis.Redis(host=worker.REDIS_HOST, port=worker.REDIS_PORT) as client:
+      await worker.create_consumer_group(client)
+
+  asyncio.run(create())
+  return services
+
+
+def run(test):
+  """Runs an async test body with the worker's own Redis client and DB pool."""
+  async def body():
+    redis_client = aioredis.Redis(host=worker.REDIS_HOST, port=worker.REDIS_PORT)
+    db_pool = await worker.get_db_pool()
+    try:
+      return await test(redis_client, db_pool)
+    finally:
+      await db_pool.close()
+      await redis_client.aclose()
+
+  return asyncio.run(body())
+
+
+def test_fetch_batch_dead_letters_undecodable_entries(stream):
+  good = uuid.uuid4()
+  stream.xadd(worker.TASK_STREAM, {"junk": b"1"})
+  stream.xadd(worker.TASK_STREAM, {"payload": b"\x01\x02"})
+  stream.xadd(worker.TASK_STREAM, {"payload": msgpack.packb(["not", "a", "map"])})
+  stream.xadd(worker.TASK_STREAM, job("not-a-uuid", value=1))
+  stream.xadd(worker.TASK_STREAM, {"payload": msgpack.packb(
+    {"task_id": 42, "task_name": "instant_task", "params": {}}
+  )})
+  good_entry = stream.xadd(worker.TASK_STREAM, job(str(good).upper(), value=1))
+
+  jobs = run(lambda redis_client, db_pool: worker.fetch_batch(redis_client))
+
+  assert jobs == [(good_entry, {"task_id": str(good), "task_name": "instant_task", "params": {"value": 1}})]
+  assert stream.xlen(worker.DEAD_LETTER_STREAM) == 5
+  assert [entry_id for entry_id, _ in stream.xrange(worker.TASK_STREAM)] == [good_entry]
+  assert stream.xpending(worker.TASK_STREAM, worker.CONSUMER_GROUP)["pending"] == 1
+
+
+def test_claim_stale_takes_over_entries_from_a_dead_consumer(stream, monkeypatch):
+  task_id = uuid.uuid4()
+  entry_id = stream.xadd(worker.TASK_STREAM, job(task_id, value=2))
+  stream.xreadgroup(worker.CONSUMER_GROUP, "dead-consumer", {worker.TASK_STREAM: ">"})
+  monkeypatch.setattr(worker, "CLAIM_IDLE_MS", 0)
+
+  next_id, jobs = run(lambda redis_client, db_pool: worker.claim_stale(redis_client))
+
+  assert next_id == b"0-0"
+  assert [claimed for claimed, _ in jobs] == [entry_id]
+  consumers = stream.xpending(worker.TASK_STREAM, worker.CONSUMER_GROUP)["consumers"]
+  assert consumers == [{"name": worker.CONSUMER_NAME.encode(), "pending": 1}]
+
+
+def test_process_batch_acks_updated_rows_and_dead_letters_after_max_deliveries(stream, monkeypatch):
+  known, missing = uuid.uuid4(), uuid.uuid4()
+  insert_task(known)
+  stream.xadd(worker.TASK_STREAM, job(known, value=3))
+  missing_entry = stream.xadd(worker.TASK_STREAM, job(missing, value=4))
+  monkeypatch.setattr(worker, "MAX_DELIVERIES", 2)
+  monkeypatch.setattr(worker, "CLAIM_IDLE_MS", 0)
+
+  async def process(redis_client, db_pool, jobs):
+    await worker.process_batch(
+      db_pool, redis_client, jobs, asyncio.Semaphore(1), worker.ProcessPool(1)
+    )
+
+  async def first_delivery(redis_client, db_pool):
+    await process(redis_client, db_pool, await worker.fetch_batch(redis_client))
+
+  run(first_delivery)
+
+  [row] = sql("SELECT status, result FROM tasks WHERE id = $1", known)
+  assert row["status"] == "COMPLETED"
+  assert orjson.loads(row["result"]) == {"value": 3}
+  assert orjson.loads(stream.get(f"task:{known}"))["status"] == "COMPLETED"
+  assert orjson.loads(stream.get(f"task:{known}:status"))["status"] == "COMPLETED"
+
+  # The job without a row stays in the stream and in the pending list for a later claim.
+  assert [entry_id for entry_id, _ in stream.xrange(worker.TASK_STREAM)] == [missing_entry]
+  pending = stream.xpending_range(worker.TASK_STREAM, worker.CONSUMER_GROUP, "-", "+", 10)
+  assert [entry["message_id"] for entry in pending] == [missing_entry]
+  assert stream.exists(worker.DEAD_LETTER_STREAM) == 0
+
+  async def second_delivery(redis_client, db_pool):
+    _, jobs = await worker.claim_stale(redis_client)
+    assert [entry_id for entry_id, _ in jobs] == [missing_entry]
+    await process(redis_client, db_pool, jobs)
+
+  run(second_delivery)
+
+  # Its second delivery hits MAX_DELIVERIES, so it is dead-lettered instead of retried forever.
+  assert stream.xlen(worker.TASK_STREAM) == 0
+  assert stream.xpending(worker.TASK_STREAM, worker.CONSUMER_GROUP)["pending"] == 0
+  [(_, dead)] = stream.xrange(worker.DEAD_LETTER_STREAM)
+  assert dead[b"entry_id"] == missing_entry
+  assert msgpack.unpackb(dead[b"payload"], raw=False)["task_id"] == str(missing)
+
+
+def run_jobs(process_pool, *jobs):
+  async def body():
+    semaphore = asyncio.Semaphore(2)
+    return [await worker.run_job(job_data, semaphore, process_pool) for job_data in jobs]
+
+  return asyncio.run(body())
+
+
+def test_plain_task_functions_run_in_the_process_pool(monkeypatch):
+  monkeypatch.setitem(worker.TASK_REGISTRY, "cpu_square", cpu_square)
+  process_pool = worker.ProcessPool(1)
+  try:
+    [(task_id, status, result)] = run_jobs(
+      process_pool, {"task_id": "t1", "task_name": "cpu_square", "params": {"value": 7}}
+    )
+  finally:
+    process_pool.shutdown()
+
+  assert (task_id, status) == ("t1", "COMPLETED")
+  result = orjson.loads(result)
+  assert result["square"] == 49
+  assert result["pid"] != os.getpid()
+
+
+def test_process_pool_is_rebuilt_after_a_child_crash(monkeypatch):
+  monkeypatch.setitem(worker.TASK_REGISTRY, "cpu_square", cpu_square)
+  monkeypatch.setitem(worker.TASK_REGISTRY, "cpu_crash", cpu_crash)
+  process_pool = worker.ProcessPool(1)
+  try:
+    crashed, recovered = run_jobs(
+      process_pool,
+      {"task_id": "t1", "task_name": "cpu_crash", "params": {}},
+      {"task_id": "t2", "task_name": "cpu_square", "params": {"value": 3}},
+    )
+  finally:
+    process_pool.shutdown()
+
+  assert crashed[1] == "FAILED"
+  assert recovered[1] == "COMPLETED"
+  assert orjson.loads(recovered[2])["square"] == 9
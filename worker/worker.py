@@ -1,11 +1,18 @@
-# File: worker/main.py
+# File: worker/worker.py
 
-import json
+import asyncio
+import functools
 import os
-import time
-import redis
-import psycopg2
-from psycopg2.extras import Json
+import socket
+import uuid
+import asyncpg
+import msgpack
+import orjson
+import redis.asyncio as aioredis
+import redis.exceptions
+import uvloop
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # --- 1. Configuration from Environment Variables ---
 
@@ -15,103 +22,336 @@ DB_PASSWORD = os.getenv("DB_PASSWORD", "password")
 DB_NAME = os.getenv("DB_NAME", "db")
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 64))
+CONCURRENCY = int(os.getenv("CONCURRENCY", 16))
+MAX_IN_FLIGHT_BATCHES = int(os.getenv("MAX_IN_FLIGHT_BATCHES", 4))
+STATUS_CACHE_TTL = int(os.getenv("STATUS_CACHE_TTL", 3600))
+TASK_STREAM = "task_stream"
+CONSUMER_GROUP = "workers"
+CONSUMER_NAME = os.getenv("CONSUMER_NAME", f"{socket.gethostname()}-{os.getpid()}")
+DEAD_LETTER_STREAM = "task_stream:dead"
+CLAIM_IDLE_MS = int(os.getenv("CLAIM_IDLE_MS", 600000))
+CLAIM_INTERVAL = float(os.getenv("CLAIM_INTERVAL", 30))
+MAX_DELIVERIES = int(os.getenv("MAX_DELIVERIES", 3))
+PROCESS_POOL_SIZE = int(os.getenv("PROCESS_POOL_SIZE", os.cpu_count() or 1))
 
 
 # --- 2. The "Business Logic" (The Actual Task Functions) ---
 
-def scan_url(url: str):
+# The simulated work waits through this name, so tests can patch it here without
+# touching asyncio.sleep for the rest of the process.
+_sleep = asyncio.sleep
+
+async def scan_url(url: str):
     """A dummy function to simulate scanning a URL for vulnerabilities."""
     print(f"WORKER: Starting to scan URL: {url}...")
     # In a real scenario, this would involve network requests, analysis, etc.
-    time.sleep(5)
+    await _sleep(5)
     print(f"WORKER: Finished scanning URL: {url}.")
     return {"status_code": 200, "title": "Example Domain", "vulnerabilities_found": 0}
 
-def fetch_ip(hostname: str):
+async def fetch_ip(hostname: str):
     """A dummy function to simulate a DNS lookup."""
     print(f"WORK-ER: Starting to fetch IP for: {hostname}...")
-    time.sleep(2)
+    await _sleep(2)
     print(f"WORKER: Finished fetching IP for: {hostname}.")
     return {"ip_address": "93.184.216.34", "hostname": hostname}
 
 
 # --- 3. The Task Registry (A Simple Dispatcher) ---
+# Coroutine functions run on the event loop. Plain functions are treated as CPU-bound
+# and run in a process pool so they neither hold the GIL nor stall the dispatch loop.
 TASK_REGISTRY = {
     "scan_url": scan_url,
     "fetch_ip": fetch_ip,
 }
 
-def get_db_connection():
-    """Establishes and returns a connection to the PostgreSQL database."""
+SQL_IN_PROGRESS = (
+    "UPDATE tasks SET status = 'IN_PROGRESS', started_at = NOW() WHERE id = ANY($1::uuid[])"
+)
+SQL_FINISHED = (
+    "UPDATE tasks AS t SET status = v.status, completed_at = NOW(), result = v.result "
+    "FROM unnest($1::uuid[], $2::text[], $3::jsonb[]) AS v(id, status, result) "
+    "WHERE t.id = v.id "
+    "RETURNING t.id, row_to_json(t)::text, json_build_object("
+    "'id', t.id, 'task_name', t.task_name, 'status', t.status, 'submitted_at', t.submitted_at, "
+    "'started_at', t.started_at, 'completed_at', t.completed_at)::text"
+)
+
+class ProcessPool:
+    """A ProcessPoolExecutor for CPU-bound tasks that is rebuilt when a crashed child breaks it."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    async def run(self, func, **kwargs):
+        executor = self.executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, functools.partial(func, **kwargs)
+            )
+        except BrokenProcessPool:
+            # Jobs caught in the crash fail, but later ones get a fresh pool instead of
+            # failing for good. Only the first job to notice replaces the executor.
+            if self.executor is executor:
+                print("WORKER: Process pool broke; starting a new one.")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            raise
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+async def reset_connection(conn):
+    """
+    No-op pool reset. The worker only runs its two UPDATEs and never leaves
+    session state behind, so asyncpg's default RESET ALL/UNLISTEN round trip on
+    every release is pure overhead.
+    """
+
+async def get_db_pool():
+    """Establishes and returns a connection pool to the PostgreSQL database."""
     while True:
         try:
-            conn = psycopg2.connect(
-                dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST
+            pool = await asyncpg.create_pool(
+                database=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST,
+                min_size=4, max_size=16,
+                # Both UPDATEs go through asyncpg's per-connection statement cache, so
+                # each is parsed and planned once per connection. PreparedStatement
+                # objects cannot be kept instead: asyncpg invalidates them on release.
+                reset=reset_connection,
             )
-            conn.autocommit = True
             print("WORKER: Database connection established.")
-            return conn
-        except psycopg2.OperationalError as e:
+            return pool
+        except (OSError, asyncpg.PostgresError) as e:
             print(f"WORKER: Database connection failed: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
+            await asyncio.sleep(5)
+
+async def create_consumer_group(redis_client):
+    """Creates the worker consumer group (and the stream itself) if it does not exist yet."""
+    try:
+        await redis_client.xgroup_create(TASK_STREAM, CONSUMER_GROUP, id="0", mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+async def decode_entries(redis_client, entries):
+    """
+    Decodes stream entries into (entry_id, job_data) pairs. An entry that cannot be
+    decoded is copied to the dead-letter stream and acked, so it can neither sink the
+    rest of its batch nor come back on every claim.
+    """
+    jobs = []
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for entry_id, fields in entries:
+            if not fields:
+                continue
+            try:
+                job_data = msgpack.unpackb(fields[b"payload"], raw=False)
+                if not (
+                    isinstance(job_data, dict)
+                    and {"task_id", "task_name"} <= job_data.keys()
+                    and isinstance(job_data.get("params"), dict)
+                ):
+                    raise ValueError("payload is not a task_id/task_name/params map")
+                if not isinstance(job_data["task_id"], str):
+                    raise ValueError("task_id is not a string")
+                # A malformed id would make the batch UPDATE raise for every job in the
+                # batch; store the canonical form so it matches the ids PG RETURNs.
+                job_data["task_id"] = str(uuid.UUID(job_data["task_id"]))
+            except (KeyError, TypeError, ValueError, msgpack.UnpackException) as e:
+                print(f"WORKER: Dead-lettering undecodable entry {entry_id}: {e!r}")
+                pipe.xadd(DEAD_LETTER_STREAM, {**fields, b"entry_id": entry_id, b"error": repr(e)})
+                pipe.xack(TASK_STREAM, CONSUMER_GROUP, entry_id)
+                pipe.xdel(TASK_STREAM, entry_id)
+                continue
+            jobs.append((entry_id, job_data))
+        # An empty pipeline returns without a round trip.
+        await pipe.execute()
+
+    return jobs
+
+async def fetch_batch(redis_client):
+    """Reads up to BATCH_SIZE new stream entries for this consumer as (entry_id, job_data) pairs."""
+    response = await redis_client.xreadgroup(
+        CONSUMER_GROUP, CONSUMER_NAME, {TASK_STREAM: ">"}, count=BATCH_SIZE, block=5000
+    )
+    if not response:
+        return []
+
+    _, entries = response[0]
+    return await decode_entries(redis_client, entries)
+
+async def claim_stale(redis_client, start_id="0-0"):
+    """
+    Takes over up to BATCH_SIZE entries that some consumer read but has not acked for
+    CLAIM_IDLE_MS, scanning the pending list from start_id. Returns the cursor for the
+    next scan ("0-0" once the whole list has been covered) and the decoded jobs.
+    """
+    next_id, entries, *_ = await redis_client.xautoclaim(
+        TASK_STREAM, CONSUMER_GROUP, CONSUMER_NAME,
+        min_idle_time=CLAIM_IDLE_MS, start_id=start_id, count=BATCH_SIZE,
+    )
+    return next_id, await decode_entries(redis_client, entries)
+
+async def retry_or_dead_letter(redis_client, jobs):
+    """
+    Leaves jobs whose row was not updated pending for a later claim, but dead-letters
+    those already delivered MAX_DELIVERIES times, so a job whose row never appears
+    cannot run again every CLAIM_IDLE_MS forever.
+    """
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for entry_id, _ in jobs:
+            pipe.xpending_range(TASK_STREAM, CONSUMER_GROUP, entry_id, entry_id, 1)
+        pending = await pipe.execute()
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for (entry_id, job_data), info in zip(jobs, pending):
+            # An entry missing from the pending list was already claimed or dropped elsewhere.
+            deliveries = info[0]["times_delivered"] if info else 0
+            if deliveries < MAX_DELIVERIES:
+                print(f"WORKER: Job {job_data['task_id']} has no task row yet; leaving it pending for a retry.")
+                continue
+            print(f"WORKER: Dead-lettering job {job_data['task_id']}: no task row after {deliveries} deliveries.")
+            pipe.xadd(DEAD_LETTER_STREAM, {
+                b"payload": msgpack.packb(job_data, use_bin_type=True),
+                b"entry_id": entry_id,
+                b"error": f"no task row after {deliveries} deliveries",
+            })
+            pipe.xack(TASK_STREAM, CONSUMER_GROUP, entry_id)
+            pipe.xdel(TASK_STREAM, entry_id)
+        await pipe.execute()
+
+async def run_job(job_data, semaphore, process_pool):
+    """Runs a single task under the concurrency limit and returns its (id, status, result) row."""
+    task_id = job_data["task_id"]
+    task_name = job_data["task_name"]
+    task_function = TASK_REGISTRY.get(task_name)
+    if not task_function:
+
+        error_result = {"error": f"Task name '{task_name}' not found in registry."}
+        print(f"WORKER: Job {task_id} failed: task not found.")
+        return task_id, "FAILED", orjson.dumps(error_result).decode()
+
+    async with semaphore:
+        try:
+            if asyncio.iscoroutinefunction(task_function):
+                result = await task_function(**job_data["params"])
+            else:
+                result = await process_pool.run(task_function, **job_data["params"])
+        except Exception as e:
+            # One bad job must not take the rest of the batch down with it.
+            print(f"WORKER: Job {task_id} failed: {e}")
+            return task_id, "FAILED", orjson.dumps({"error": str(e)}).decode()
+
+    print(f"WORKER: Job {task_id} completed successfully.")
+    return task_id, "COMPLETED", orjson.dumps(result).decode()
+
+async def process_batch(db_pool, redis_client, jobs, semaphore, process_pool):
+    """Moves a batch to IN_PROGRESS, runs its tasks concurrently, writes all outcomes back and acks it."""
+    entry_ids = {}
+    for entry_id, job_data in jobs:
+        entry_ids.setdefault(job_data["task_id"], []).append(entry_id)
+    batch, jobs = jobs, [job_data for _, job_data in jobs]
+    # One write per batch rather than per job keeps stdout off the dispatch path.
+    print(f"WORKER: Picked up {len(jobs)} job(s): " + ", ".join(
+        f"{job_data['task_id']} ({job_data['task_name']})" for job_data in jobs
+    ))
+
+    try:
+        # --- 5. Update State: one bulk UPDATE for the whole batch ---
+        await db_pool.execute(SQL_IN_PROGRESS, [job_data["task_id"] for job_data in jobs])
+
+        # --- 6. Execute Tasks and Collect Outcomes ---
+        outcomes = await asyncio.gather(
+            *(run_job(job_data, semaphore, process_pool) for job_data in jobs)
+        )
+        ids, statuses, results = zip(*outcomes)
+
+        finished = await db_pool.fetch(SQL_FINISHED, ids, statuses, results)
+
+        # Prime the API's status cache so pollers see the final state without a PG read,
+        # then ack and drop the entries whose rows were actually updated. The rest are
+        # retried by a later claim, up to MAX_DELIVERIES times.
+        done_ids = []
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for task_id, task_json, summary_json in finished:
+                pipe.set(f"task:{task_id}", task_json, ex=STATUS_CACHE_TTL)
+                pipe.set(f"task:{task_id}:status", summary_json, ex=STATUS_CACHE_TTL)
+                done_ids.extend(entry_ids.pop(str(task_id), ()))
+            if done_ids:
+                pipe.xack(TASK_STREAM, CONSUMER_GROUP, *done_ids)
+                pipe.xdel(TASK_STREAM, *done_ids)
+            await pipe.execute()
+
+        if entry_ids:
+            await retry_or_dead_letter(redis_client, [
+                (entry_id, job_data) for entry_id, job_data in batch
+                if job_data["task_id"] in entry_ids
+            ])
 
-def main():
+    # --- 7. Error Handling and Resilience ---
+    except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+        # The pool replaces broken connections on its own; the next batch gets a fresh one.
+        print(f"WORKER: Database error: {e}")
+    except redis.exceptions.RedisError as e:
+        print(f"WORKER: Redis error while acknowledging results: {e}")
+    except Exception as e:
+
+        print(f"WORKER: An unexpected error occurred: {e}")
+
+async def main():
     """The main loop of the worker process."""
     print("WORKER: Starting up...")
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-    db_conn = get_db_connection()
+    redis_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    db_pool = await get_db_pool()
+    await create_consumer_group(redis_client)
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    process_pool = ProcessPool(PROCESS_POOL_SIZE)
+    in_flight = set()
+    loop = asyncio.get_running_loop()
+    claim_cursor = "0-0"
+    next_claim_at = loop.time()
 
-    while True:
-        try:
-            # --- 4. The Core Loop: Blocking Pop from Redis ---
-            print("WORKER: Waiting for a new job from the queue...")
-            _, job_json = redis_client.brpop("task_queue")
-            job_data = json.loads(job_json)
-
-            task_id = job_data["task_id"]
-            task_name = job_data["task_name"]
-            params = job_data["params"]
-            print(f"WORKER: Picked up job {task_id} ({task_name})")
-
-            # --- 5. Update State: ---
-            with db_conn.cursor() as cur:
-                cur.execute(
-                    "UPDATE tasks SET status = 'IN_PROGRESS', started_at = NOW() WHERE id = %s",
-                    (task_id,)
+    try:
+        while True:
+            try:
+                # --- 4. The Core Loop: Blocking Batched Read from the Stream ---
+                if len(in_flight) >= MAX_IN_FLIGHT_BATCHES:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                if loop.time() >= next_claim_at:
+                    # Recover work left pending by dead consumers on a timer, not only when
+                    # the stream is idle; keep scanning straight away while the cursor has
+                    # not wrapped around.
+                    claim_cursor, jobs = await claim_stale(redis_client, claim_cursor)
+                    if claim_cursor in ("0-0", b"0-0"):
+                        next_claim_at = loop.time() + CLAIM_INTERVAL
+                else:
+                    print("WORKER: Waiting for a new job from the queue...")
+                    jobs = await fetch_batch(redis_client)
+                if not jobs:
+                    continue
+
+                batch_task = asyncio.create_task(
+                    process_batch(db_pool, redis_client, jobs, semaphore, process_pool)
                 )
+                in_flight.add(batch_task)
+                batch_task.add_done_callback(in_flight.discard)
 
-            # --- 6. Execute Task and Handle Outcome ---
-            task_function = TASK_REGISTRY.get(task_name)
-            if task_function:
-                result = task_function(**params)
-                with db_conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE tasks SET status = 'COMPLETED', completed_at = NOW(), result = %s WHERE id = %s",
-                        (Json(result), task_id)
-                    )
-                print(f"WORKER: Job {task_id} completed successfully.")
-            else:
-                
-                error_result = {"error": f"Task name '{task_name}' not found in registry."}
-                with db_conn.cursor() as cur:
-                    cur.execute(
-                        "UPDATE tasks SET status = 'FAILED', completed_at = NOW(), result = %s WHERE id = %s",
-                        (Json(error_result), task_id)
-                    )
-                print(f"WORKER: Job {task_id} failed: task not found.")
-
-        # --- 7. Error Handling and Resilience ---
-        except psycopg2.Error as e:
-            print(f"WORKER: Database error: {e}. Attempting to reconnect...")
-            db_conn = get_db_connection() 
-        except redis.exceptions.RedisError as e:
-            print(f"WORKER: Redis error: {e}. Retrying in 5 seconds...")
-            time.sleep(5) 
-        except Exception as e:
-            
-            print(f"WORKER: An unexpected error occurred: {e}")
-            
-            time.sleep(5)
+            except redis.exceptions.RedisError as e:
+                print(f"WORKER: Redis error: {e}. Retrying in 5 seconds...")
+                await asyncio.sleep(5)
+            except Exception as e:
+
+                print(f"WORKER: An unexpected error occurred: {e}")
+
+                await asyncio.sleep(5)
+    finally:
+        process_pool.shutdown()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    uvloop.install()
+    asyncio.run(main())